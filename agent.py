@@ -1,38 +1,69 @@
 import os
+import asyncio
+import time
+import random
+import logging
 from mistralai import Mistral
 import discord
-import aiohttp
+import httpx
 import json
+import orjson
+import hashlib
+import functools
+import re
+
+from bot_text import process_response
+from cache import ImageCache, LLMCache, SemanticCache
+
+logger = logging.getLogger("discord")
 
 MISTRAL_MODEL = "mistral-large-latest"
+# Sampling parameters for calls that write instructions. Bounding the output keeps decode time in check,
+# and a low temperature makes repeated requests produce (and hit the cache with) the same answer.
+INSTRUCTION_PARAMS = {"max_tokens": 2048, "temperature": 0.2}
 BFL_MODEL = 'flux-pro-1.1'
+# Generation statuses after which polling will never see 'Ready'
+BFL_FAILED_STATUSES = ('Error', 'Request Moderated', 'Content Moderated', 'Task not found')
+# Generations whose image cache key is remembered until their result is known
+MAX_PENDING_GENERATIONS = 256
+
+# The trigger phrase bot.py routes build requests on, which is not part of what is to be built
+BUILD_TRIGGER_RE = re.compile(r'^\s*Bob, please build( me)?\b', re.IGNORECASE)
+# Things that are never reasonable to build, in line with the examples in BUILD_REQUEST_PROMPT.
+# Requests for just one of them are rejected without asking Mistral. Anything more, e.g.
+# "a sun dial" or "a model of the sun", is still left to the model to judge.
+UNREASONABLE_BUILD_RE = re.compile(
+    r'^(an? |the )?(sun|planet|galaxy|universe|black hole|nuclear \w+|atomic bomb|time machine'
+    r'|perpetual motion machine)s?\s*$',
+    re.IGNORECASE,
+)
+
+BUILD_REQUEST_PROMPT = """
+You are BuilderBot, a highly skilled maker and DIY expert with extensive knowledge of building and crafting various items. You have practical experience in woodworking, basic electronics, home improvement, and general crafting.
+You know how to build furniture like tables and chairs, as well as assemble and repair computers and other electronic devices that can be made or fixed at home.
+
+First, decide whether the message is a reasonable request for building something. The message must both be an actual
+request to build something and be reasonable enough that one could explain how to build it relatively briefly.
 
-VERIFY_REASONABLE_REQUEST = """
-Is this message a reasonable request for building something? The message must both be an actual
-request to build something and be reasonable enough that one could explain how to build it
-relatively briefly.
+If it is not, respond with exactly "no" and nothing else.
 
-Answer with either "no" or the words of the thing to build.
+If it is, the first line of your response must be exactly:
+Build: [the words of the thing to build]
 
-Example:
+Examples of the first line:
 Message: generate instructions for building a chair
-Response: a chair
+First line: Build: a chair
 
 Message: generate instructions for building the sun
-Response: no
+First line: no
 
 Message: tell me the circumference of the earth
-Response: no
+First line: no
 
 Message: a carpet
-Response: a carpet
-"""
-
-INSTRUCTION_PROMPT = """
-You are BuilderBot, a highly skilled maker and DIY expert with extensive knowledge of building and crafting various items. You have practical experience in woodworking, basic electronics, home improvement, and general crafting.
-You know how to build furniture like tables and chairs, as well as assemble and repair computers and other electronic devices that can be made or fixed at home.
+First line: Build: a carpet
 
-Your purpose is to provide clear, step-by-step instructions for building or repairing items. You must ALWAYS structure your responses in exactly this format:
+After the first line, provide clear, step-by-step instructions for building or repairing the item in exactly this format:
 
 Materials:
 - [List all required materials with approximate quantities]
@@ -50,7 +81,7 @@ Rules:
 2. Break down complex tasks into smaller, manageable steps
 3. Each step must be formatted exactly as specified above
 4. Keep steps clear and concise
-5. Never include any other text or explanations beyond the materials/tools list and numbered steps
+5. Never include any other text or explanations beyond the first line, the materials/tools list and numbered steps
 6. Never engage in conversation or respond to questions - only provide building instructions
 
 Remember: You are an expert maker who knows exactly how to build these items. Maintain complete confidence in your abilities while staying within the realm of practical home DIY projects.
@@ -67,7 +98,7 @@ The step that the user will request elaboration on will start with << and end wi
 
 You are only supposed to elaborated on the step encased in <<    and    >>
 
-However, the other steps in the build sequence are listed for context after the elaborated step
+However, the other steps in the build sequence are listed for context before the elaborated step
 
 You should give a brief explanation, then give a new set of instructions for the step that expands on the details and technical knowhow. The reformatted instructions should follow the following form:
 
@@ -166,9 +197,211 @@ After the table, provide:
 
 Be realistic and practical with your estimates. Use current average US prices. For the "Where to Buy" column, suggest common retailers where these items can be purchased (e.g., Home Depot, Lowe's, Amazon, craft stores, etc.).
 
-The materials or step to estimate costs for is enclosed between << and >>:
+The other steps of the build are listed first for context. The materials or step to estimate costs for is enclosed between << and >>:
 """
 
+# The image prompts with the opening of the << >> bookends already attached, so building a final
+# prompt is a single concatenation that does not re-copy the static prefix into temporaries.
+IMAGE_STEP_PREFIX = IMAGE_STEP_PROMPT + " << "
+IMAGE_ELAB_PREFIX = IMAGE_ELABORATION_PROMPT + " << "
+IMAGE_SUFFIX = " >>"
+
+
+def _parse_build_header(line):
+    """
+    Returns:
+        str: The thing to build named by a "Build: ..." header line, or None if the line is not one
+    """
+    line = line.strip()
+    if line.lower().startswith("build:"):
+        return line[len("build:"):].strip()
+    return None
+
+
+def _is_rejection_header(line):
+    """
+    Returns:
+        bool: True if the line is the "no" a BUILD_REQUEST_PROMPT response starts with when the
+              request is not reasonable, e.g. "No." or "**no**"
+    """
+    return line.strip().strip(" \t.!,;:\"'*`").lower() == "no"
+
+
+def _parse_build_response(response):
+    """
+    Splits a BUILD_REQUEST_PROMPT response into the thing to build and its instructions.
+
+    Returns:
+        tuple: (thing to build, instructions), or (None, None) if the request was not reasonable
+    """
+    header, _, instructions = response.strip().partition("\n")
+    to_build = _parse_build_header(header)
+    if to_build is not None:
+        return to_build, instructions.strip()
+
+    # The model occasionally skips the header line but still answers with instructions.
+    if "#### Step" in response:
+        return None, response.strip()
+
+    return None, None
+
+
+def _obviously_unreasonable(content):
+    """
+    Cheap local check for build requests that can be rejected without a Mistral round trip.
+
+    Returns:
+        bool: True if the request names nothing to build or something on the blocklist
+    """
+    to_build = BUILD_TRIGGER_RE.sub("", content, count=1).strip(" \t\n.,!?:")
+    return not to_build or UNREASONABLE_BUILD_RE.match(to_build) is not None
+
+
+class _StreamPreview:
+    """
+    Shows a response in a Discord message while it is being streamed. The message is edited at most
+    every `interval` seconds, to stay within Discord's edit rate limits.
+    """
+
+    def __init__(self, status, heading, interval=0.5):
+        """
+        Args:
+            status: Awaitable resolving to the discord.Message to edit (typically the task replying with it)
+            heading (str): Text shown above the streamed response
+            interval (float): Minimum number of seconds between edits
+        """
+        self.status = status
+        self.heading = heading
+        self.interval = interval
+        self._parts = []
+        self._last_edit = 0.0
+        self._edit_task = None
+
+    def feed(self, delta):
+        self._parts.append(delta)
+        now = time.monotonic()
+        if now - self._last_edit >= self.interval and (self._edit_task is None or self._edit_task.done()):
+            self._last_edit = now
+            self._edit_task = asyncio.create_task(self._edit(self._render()))
+
+    def _render(self):
+        # Only the end of the response is shown, to stay under Discord's 2000 character limit.
+        text = "".join(self._parts)
+        room = 1990 - len(self.heading)
+        if len(text) > room:
+            text = "..." + text[-(room - 3):]
+        return f"{self.heading}\n{text}"
+
+    async def _edit(self, content):
+        status_message = await self.status
+        try:
+            await status_message.edit(content=content)
+        except discord.HTTPException:
+            # A missed preview update is harmless; the full response is still returned.
+            pass
+
+    async def finish(self, content):
+        """
+        Waits for any pending preview edit, then replaces the preview with its final content.
+        """
+        if self._edit_task is not None:
+            await self._edit_task
+        await self._edit(content)
+
+
+class _TokenBucket:
+    """
+    Limits how many requests per unit of time are sent to an API. Up to `capacity` requests go out
+    immediately; after that, `refill_amount` more are allowed every `refill_frequency` seconds.
+    """
+
+    def __init__(self, capacity, refill_amount, refill_frequency):
+        self.capacity = capacity
+        self.refill_amount = refill_amount
+        self.refill_frequency = refill_frequency
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        refills = int((now - self._last_refill) / self.refill_frequency)
+        if refills:
+            self._tokens = min(self.capacity, self._tokens + refills * self.refill_amount)
+            self._last_refill += refills * self.refill_frequency
+
+    async def acquire(self):
+        """
+        Waits until a request may be sent, then takes a token for it.
+        """
+        while True:
+            self._refill()
+            if self._tokens > 0:
+                self._tokens -= 1
+                return
+            await asyncio.sleep(self._last_refill + self.refill_frequency - time.monotonic())
+
+
+def illustrated_step_indices(step_count):
+    """
+    Picks which steps of a build get an illustration: the first, middle and last step.
+
+    Args:
+        step_count (int): Number of steps in the build
+
+    Returns:
+        list: Sorted 0-based indices of the steps to illustrate
+    """
+    indices = set()
+    if step_count > 0:
+        indices.add(0)
+    if step_count > 2:
+        indices.add(step_count // 2)
+    if step_count > 1:
+        indices.add(step_count - 1)
+    return sorted(indices)
+
+
+def step_sections(instruction):
+    """
+    Splits instructions into their step sections, exactly as bot.py replies with them.
+
+    Args:
+        instruction (str): The generated instructions
+
+    Returns:
+        list: Each "#### Step N: ..." section with all of its lines, units and dimensions bolded
+    """
+    return [section for is_step, section in process_response(instruction) if is_step]
+
+
+def _step_image_prompt(step):
+    # Prefetched and requested step images are generated from the same prompt, so they share cache keys.
+    return f"{IMAGE_STEP_PREFIX}{step}{IMAGE_SUFFIX}"
+
+
+def _format_step_request(step, all_steps):
+    # The build context goes first and the requested step last: requests about different steps of the
+    # same build then share the longest possible prompt prefix, which the provider can cache.
+    return all_steps + "\n\n\n\n<< " + step + " >>"
+
+
+@functools.lru_cache(maxsize=2048)
+def _content_key(text):
+    # The same prompts and message contents get hashed by several cache tiers per request, so the digest
+    # of each unique string is memoized.
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _normalize(text):
+    # Requests that only differ in case or spacing ("A chair" vs "a  chair ") get the same answer.
+    return " ".join(text.split()).lower()
+
+
+def _cache_key(model, system, user, params=None):
+    # Everything that determines the completion goes into the key.
+    params_json = json.dumps(params or {}, sort_keys=True)
+    return _content_key(f"{model}\0{_content_key(system)}\0{_content_key(user)}\0{params_json}")
+
 
 class BuilderAgent:
     def __init__(self):
@@ -176,96 +409,372 @@ class BuilderAgent:
 
         self.client = Mistral(api_key=MISTRAL_API_KEY)
 
-    async def is_reasonable_request(self, message: discord.Message):
-        # Verify if the message is a reasonable request for something to build.
-        response = await self.client.chat.complete_async(
-            model=MISTRAL_MODEL,
-            messages=[
-                {"role": "system", "content": VERIFY_REASONABLE_REQUEST},
-                {"role": "user", "content": message.content},
-            ]
+        # The BFL key never changes, so it is read once and sent as a default header of the BFL client.
+        self._bfl_key = os.getenv("BFL_API_KEY")
+
+        self.cache = LLMCache()
+        self.semantic_cache = SemanticCache()
+        # Futures for requests that are currently in flight, keyed by request hash
+        self._inflight = {}
+        # Shared HTTP/2 client for BFL calls: connections are kept alive between requests, and concurrent
+        # requests (e.g. several image status polls) are multiplexed over a single connection.
+        self._http = httpx.AsyncClient(
+            http2=True,
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=100, keepalive_expiry=75),
+            base_url="https://api.us1.bfl.ai/v1",
+            headers={'accept': 'application/json', 'x-key': self._bfl_key or ''},
         )
+        # Image generations started ahead of time, keyed by (build request message ID, step number)
+        self._pending_images = {}
+        self._img_cache = ImageCache()
+        # Stays under BFL's limit on concurrent requests when many images are generated at once
+        self._bfl_sem = asyncio.Semaphore(4)
+        # Bounds how many Mistral calls are in flight at once, e.g. when requests are batched
+        self._mistral_sem = asyncio.Semaphore(8)
+        # Keeps bursts of requests under the providers' per-minute rate limits, so they are delayed
+        # here instead of being rejected with a 429
+        self._mistral_bucket = _TokenBucket(capacity=10, refill_amount=1, refill_frequency=0.25)
+        self._bfl_bucket = _TokenBucket(capacity=8, refill_amount=1, refill_frequency=0.5)
+        # Image cache keys of generations that have not finished yet, keyed by generation ID. Entries
+        # are removed once a generation is ready, has failed or is given up on.
+        self._generation_keys = {}
+
+    async def start(self):
+        """
+        Does the slow one-time setup up front, so the first request doesn't pay for it.
+        Call this once before handling messages.
+        """
+        # Opening the connections now moves the DNS lookups and TLS handshakes off the first request.
+        # A failed warmup only means that request pays for them after all.
+        results = await asyncio.gather(
+            self.semantic_cache.load_model(),
+            self.client.models.list_async(),
+            self._http.head(f"/{BFL_MODEL}"),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("Warmup failed: %r", result)
+
+    async def close(self):
+        """
+        Closes the shared HTTP client and the cache databases. Call this once when shutting down.
+        """
+        await self._http.aclose()
+        self._img_cache.close()
+        self.semantic_cache.close()
 
-        return response.choices[0].message.content
+    async def _singleflight(self, key, call):
+        """
+        Runs `call()` unless an identical request is already in flight, in which case
+        the caller shares the result of the in-flight request instead.
 
-    async def get_instructions(self, message: discord.Message):
-        response = await self.client.chat.complete_async(
-            model=MISTRAL_MODEL,
-            messages=[
-                {"role": "system", "content": INSTRUCTION_PROMPT},
-                {"role": "user", "content": message.content},
-            ]
-        )
+        Args:
+            key (str): Identifies the request
+            call: Zero-argument function returning the awaitable to run
+
+        Returns:
+            The result of the (possibly shared) request
+        """
+        while key in self._inflight:
+            shared = self._inflight[key]
+            try:
+                return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                # If only the caller that ran the request was cancelled, e.g. a prefetch that was no
+                # longer needed, this caller runs (or joins) the request again instead.
+                if not shared.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await call()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Mark the exception as retrieved so nothing is logged when no one else was waiting.
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    async def _complete(self, system, user, model=MISTRAL_MODEL, semantic=False, normalize=False,
+                        on_delta=None, **params):
+        """
+        Sends a system + user prompt to Mistral, serving identical requests from the response cache.
 
-        return response.choices[0].message.content
+        Args:
+            system (str): The system prompt
+            user (str): The user message content
+            model (str): The Mistral model to use
+            semantic (bool): Whether paraphrases of earlier requests may be served from the semantic cache
+            normalize (bool): Whether requests differing only in case and whitespace share a cache entry
+            on_delta: If given, the response is streamed and this is called with each new piece of text.
+                      Returning False from it stops the generation there. It is not called for responses
+                      served from a cache or shared with an identical in-flight request.
+            **params: Extra sampling parameters for the API call, e.g. max_tokens or temperature
 
-    async def get_elaboration(self, message: discord.Message, step, all_steps):
-        formatted_content = "<< " + step + " >> \n\n\n\n" + all_steps
+        Returns:
+            str: The content of the model's response
+        """
+        key = _cache_key(model, system, _normalize(user) if normalize else user, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        embedding = None
+        if semantic:
+            namespace = _cache_key(model, system, "", params)
+            # The constant "Bob, please build me" would make short, different requests look alike, so only
+            # the rest of the message is compared.
+            embedding = await self.semantic_cache.embed(BUILD_TRIGGER_RE.sub("", user, count=1).strip())
+            cached = self.semantic_cache.get(namespace, embedding)
+            if cached is not None:
+                self.cache.set(key, cached)
+                return cached
+
+        # The system prompt is always a module constant sent as the first message, so every call with
+        # the same prompt shares a byte-identical prefix that Mistral can serve from its prefix cache.
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ]
+
+        async def call():
+            async with self._mistral_sem:
+                await self._mistral_bucket.acquire()
+                if on_delta is None:
+                    response = await self.client.chat.complete_async(model=model, messages=messages, **params)
+                    content = response.choices[0].message.content
+                else:
+                    content = await self._stream(model, messages, on_delta, params)
+
+            self.cache.set(key, content)
+            if semantic:
+                self.semantic_cache.add(namespace, embedding, content)
+            return content
+
+        return await self._singleflight(key, call)
+
+    async def _stream(self, model, messages, on_delta, params):
+        parts = []
+        response = await self.client.chat.stream_async(model=model, messages=messages, **params)
+        async with response as event_stream:
+            async for chunk in event_stream:
+                delta = chunk.data.choices[0].delta.content
+                if isinstance(delta, str) and delta:
+                    parts.append(delta)
+                    # Returning False from on_delta stops generation early; leaving the context closes
+                    # the stream.
+                    if on_delta(delta) is False:
+                        break
+        return "".join(parts)
+
+    async def get_build(self, message: discord.Message, on_delta=None):
+        """
+        Checks that the message is a reasonable build request and, if so, gets instructions for it,
+        all in a single Mistral call.
 
-        response = await self.client.chat.complete_async(
-            model=MISTRAL_MODEL,
-            messages=[
-                {"role": "system", "content": ELABORATION_PROMPT},
-                {"role": "user", "content": formatted_content},
-            ]
+        Args:
+            message (discord.Message): The message requesting a build
+            on_delta: Optional callback receiving the raw response as it streams in
+
+        Returns:
+            tuple: (thing to build, instructions). Instructions are None if the request was not
+                   reasonable, and the thing to build may be None if the model did not name it.
+        """
+        response = await self._complete(
+            BUILD_REQUEST_PROMPT, message.content, semantic=True, normalize=True, on_delta=on_delta,
+            **INSTRUCTION_PARAMS,
         )
+        return _parse_build_response(response)
 
-        return response.choices[0].message.content
+    async def get_elaboration(self, message: discord.Message, step, all_steps, on_delta=None):
+        formatted_content = _format_step_request(step, all_steps)
+
+        return await self._complete(
+            ELABORATION_PROMPT, formatted_content, on_delta=on_delta, **INSTRUCTION_PARAMS
+        )
 
     async def run(self, message: discord.Message):
-        # Make sure the request is reasonable before getting instructions.
-        to_build = await self.is_reasonable_request(message)
-        if to_build == "no":
+        if _obviously_unreasonable(message.content):
+            await message.reply("Your request to Bob was not reasonable.")
+            return None
+
+        # Make sure the request is reasonable and get the instructions in one round trip.
+        # The response is streamed: as soon as the header line says what is being built, we reply and
+        # keep that reply updated with the instructions generated so far.
+        # Prefetched images belong to this build only, so concurrent builds in a channel don't mix them up.
+        build_id = message.id
+        header_parts = []
+        preview = None
+        # The line of the instructions being streamed, until the first step has been seen completely
+        partial_line = ""
+        # The lines of the first step, once its header has been streamed
+        first_step = None
+
+        def feed(text):
+            nonlocal partial_line, first_step
+            preview.feed(text)
+            if partial_line is None:
+                return
+            # The first step is always illustrated, so its image can be generated while the rest of
+            # the instructions are still being written. Only lines that are complete are checked, and
+            # the step is complete once the next header starts.
+            *lines, partial_line = (partial_line + text).split("\n")
+            for line in lines:
+                if line.startswith("#### "):
+                    if first_step is not None:
+                        break
+                    if step_sections(line):
+                        first_step = [line]
+                elif first_step is not None:
+                    first_step.append(line)
+            else:
+                # The next header can be recognized before its line is complete.
+                if first_step is None or not partial_line.startswith("#### "):
+                    return
+            self._prefetch_step_image(build_id, 1, step_sections("\n".join(first_step))[0])
+            partial_line = None
+
+        def on_delta(delta):
+            nonlocal preview
+            if preview is not None:
+                feed(delta)
+                return
+
+            header_parts.append(delta)
+            header, newline, rest = "".join(header_parts).partition("\n")
+            if not newline:
+                return
+            if _is_rejection_header(header):
+                # Rejected: whatever the model would write after that is discarded anyway.
+                return False
+
+            to_build = _parse_build_header(header)
+            heading = f"Generating instructions for building {to_build or 'your request'}..."
+            preview = _StreamPreview(asyncio.create_task(message.reply(heading)), heading)
+            # Without a header line the whole response is instructions.
+            shown = rest if to_build is not None else "".join(header_parts)
+            if shown:
+                feed(shown)
+
+        to_build, instruction = await self.get_build(message, on_delta=on_delta)
+        if instruction is None:
             # TODO: Do we want to allow message replies within the Agent?
             # it messes up our abstraction a little bit but it would be difficult to handle in bot.py
             # because we are currently awaiting agent.run().
-            await message.reply("Your request to Bob was not reasonable.")
+            if preview is not None:
+                await preview.finish("Your request to Bob was not reasonable.")
+            else:
+                await message.reply("Your request to Bob was not reasonable.")
             return None
 
-        await message.reply(f"Generating instructions for building {to_build}...")
-
-        instruction = await self.get_instructions(message)
+        heading = f"Generating instructions for building {to_build or 'your request'}..."
+        if preview is not None:
+            await preview.finish(heading)
+        else:
+            # Served from a cache, so nothing was streamed.
+            await message.reply(heading)
         # print("MISTRAL RESPONSE:", instruction)
 
+        # Start the (remaining) step illustrations now so they are (nearly) ready by the time they are
+        # asked for.
+        self._prefetch_step_images(build_id, instruction)
+
         return instruction
 
+    def cancel_prefetched_images(self, build_id):
+        """
+        Cancels the image generations prefetched for a build that were not picked up by generate_image_step.
+        Call this once all of the build's step images have been requested.
+
+        Args:
+            build_id (int): ID of the message that requested the build
+        """
+        for key in [key for key in self._pending_images if key[0] == build_id]:
+            task = self._pending_images.pop(key)
+            task.cancel()
+            # A generation that had already been started will never be polled.
+            if task.done() and not task.cancelled() and task.exception() is None:
+                self._generation_keys.pop(task.result().get('id'), None)
+
+    def _prefetch_step_image(self, build_id, step_number, step):
+        # Starts generating the illustration of one step, unless that has already been done.
+        key = (build_id, step_number)
+        if key not in self._pending_images:
+            self._pending_images[key] = asyncio.create_task(self._generate_cached(_step_image_prompt(step)))
+
+    def _prefetch_step_images(self, build_id, instruction):
+        """
+        Starts image generation for the steps that will be illustrated, in the background.
+        generate_image_step picks the results up when it is called with the same build and step.
+
+        Args:
+            build_id (int): ID of the message that requested the build
+            instruction (str): The generated instructions
+        """
+        steps = step_sections(instruction)
+        for index in illustrated_step_indices(len(steps)):
+            self._prefetch_step_image(build_id, index + 1, steps[index])
 
     async def elaborate(self, message: discord.Message, step_ID: int, builds_ago: int, step_list: list):
         # Make sure the request is reasonable before getting instructions.
         
 
-        await message.reply(f"Elaborating on step {step_ID}, {builds_ago} build(s) ago...")
+        heading = f"Elaborating on step {step_ID}, {builds_ago} build(s) ago..."
+        preview = _StreamPreview(asyncio.create_task(message.reply(heading)), heading)
 
-        all_steps = ""
-        for step in step_list:
-            all_steps = all_steps + "\n" + step
-        instruction = await self.get_elaboration(message, step_list[step_ID - 1], all_steps)
+        all_steps = "\n".join(step_list)
+        instruction = await self.get_elaboration(
+            message, step_list[step_ID - 1], all_steps, on_delta=preview.feed
+        )
+        await preview.finish(heading)
         # print("MISTRAL RESPONSE:", instruction)
 
         return instruction
         
-    async def get_cost_estimate(self, message: discord.Message, step, all_steps):
+    async def batch_elaborate(self, message: discord.Message, step_list: list, step_IDs: list):
+        """
+        Elaborates on several steps of a build concurrently.
+
+        Args:
+            message (discord.Message): The message that initiated the elaboration
+            step_list (list): List of steps in the build
+            step_IDs (list): 1-based IDs of the steps to elaborate on
+
+        Returns:
+            list: One elaboration per requested step, in the same order
+        """
+        all_steps = "\n".join(step_list)
+        return await asyncio.gather(
+            *(self.get_elaboration(message, step_list[step_ID - 1], all_steps) for step_ID in step_IDs)
+        )
+
+    async def get_cost_estimate(self, message: discord.Message, step, all_steps, on_delta=None):
         """Generate a cost estimate for the materials in a specific step or all steps.
         
         Args:
             message (discord.Message): The message that initiated the cost estimation
             step (str): The specific step to estimate costs for
             all_steps (str): All steps in the build for context
+            on_delta: Optional callback receiving the estimate as it streams in
             
         Returns:
             str: A detailed cost estimate for the materials
         """
-        formatted_content = "<< " + step + " >> \n\n\n\n" + all_steps
+        formatted_content = _format_step_request(step, all_steps)
 
-        response = await self.client.chat.complete_async(
-            model=MISTRAL_MODEL,
-            messages=[
-                {"role": "system", "content": COST_ESTIMATION_PROMPT},
-                {"role": "user", "content": formatted_content},
-            ]
+        return await self._complete(
+            COST_ESTIMATION_PROMPT, formatted_content, on_delta=on_delta, max_tokens=1024
         )
-
-        return response.choices[0].message.content
         
     async def estimate_costs(self, message: discord.Message, step_ID: int, builds_ago: int, step_list: list):
         """Estimate the costs for materials in a specific step.
@@ -279,41 +788,84 @@ class BuilderAgent:
         Returns:
             str: A detailed cost estimate for the materials in the step
         """
-        await message.reply(f"Estimating costs for step {step_ID}, {builds_ago} build(s) ago...")
+        heading = f"Estimating costs for step {step_ID}, {builds_ago} build(s) ago..."
+        preview = _StreamPreview(asyncio.create_task(message.reply(heading)), heading)
 
-        all_steps = ""
-        for step in step_list:
-            all_steps = all_steps + "\n" + step
-            
-        cost_estimate = await self.get_cost_estimate(message, step_list[step_ID - 1], all_steps)
+        all_steps = "\n".join(step_list)
+
+        cost_estimate = await self.get_cost_estimate(
+            message, step_list[step_ID - 1], all_steps, on_delta=preview.feed
+        )
+        await preview.finish(heading)
         
         return cost_estimate
 
+    async def batch_estimate_costs(self, message: discord.Message, step_list: list, step_IDs: list):
+        """
+        Estimates the costs of several steps of a build concurrently.
+
+        Args:
+            message (discord.Message): The message that initiated the cost estimation
+            step_list (list): List of steps in the build
+            step_IDs (list): 1-based IDs of the steps to estimate costs for
+
+        Returns:
+            list: One cost estimate per requested step, in the same order
+        """
+        all_steps = "\n".join(step_list)
+        return await asyncio.gather(
+            *(self.get_cost_estimate(message, step_list[step_ID - 1], all_steps) for step_ID in step_IDs)
+        )
+
     async def _start_generation(self, prompt, width=1024, height=1024):
-        print(f"Starting image generation with prompt: '{prompt}'")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"https://api.us1.bfl.ai/v1/{BFL_MODEL}",
-                headers={
-                    'Content-Type': 'application/json',
-                    'accept': 'application/json',
-                    'x-key': os.environ.get('BFL_API_KEY'),
-                },
+        key = _cache_key(BFL_MODEL, prompt, f"{width}x{height}")
+        return await self._singleflight(key, lambda: self._post_generation(prompt, width, height))
+
+    async def _post_generation(self, prompt, width, height):
+        logger.debug("Starting image generation with prompt: %r", prompt)
+        # Bounds how many BFL submissions are in flight at once.
+        async with self._bfl_sem:
+            await self._bfl_bucket.acquire()
+            response = await self._http.post(
+                f"/{BFL_MODEL}",
                 json={
                     'prompt': prompt,
                     'width': width,
                     'height': height,
                 }
-            ) as response:
-                response_text = await response.text()
-                data = json.loads(response_text)
-                print(f"Response data: {json.dumps(data, indent=2)}")
-                
-                generation_id = data.get('id')
-                if generation_id:
-                    return {'id': generation_id}, 200
-                else:
-                    return {'error': f'Failed to find generation ID in response: {data}'}, 400
+            )
+
+        data = orjson.loads(response.content)
+        logger.debug("BFL response: %s", data)
+
+        generation_id = data.get('id')
+        if generation_id:
+            return {'id': generation_id}, 200
+        else:
+            return {'error': f'Failed to find generation ID in response: {data}'}, 400
+
+    async def _generate_cached(self, final_prompt):
+        """
+        Starts an image generation unless the same prompt was generated recently.
+
+        Returns:
+            dict: {'url': ..., 'cached': True} for a cached image, otherwise the response of
+                  _start_generation (a generation ID or an error message)
+        """
+        key = _content_key(final_prompt)
+        url = self._img_cache.get(key)
+        if url is not None:
+            return {'url': url, 'cached': True}
+
+        result, _ = await self._start_generation(final_prompt)
+        if 'id' in result:
+            # check_image_status stores the URL once the generation is ready.
+            self._generation_keys[result['id']] = key
+            # Generations whose result is never asked for must not pile up, so only the most recent
+            # ones are remembered.
+            if len(self._generation_keys) > MAX_PENDING_GENERATIONS:
+                del self._generation_keys[next(iter(self._generation_keys))]
+        return result
 
     async def generate_image(self, prompt, width=1024, height=1024):
         """
@@ -334,24 +886,42 @@ class BuilderAgent:
         result, _ = await self._start_generation(prompt)
         return result
 
-    async def generate_image_step(self, prompt, width=1024, height=1024):
+    async def generate_image_step(self, prompt, width=1024, height=1024, build_id=None, step_number=None):
         """
         Initiates an image generation request using the BFL API.
         
         Args:
-            prompt (str): The text prompt for image generation
+            prompt (str): The step to illustrate, as split off by step_sections (or process_response)
             width (int): Width of the image in pixels (default: 1024)
             height (int): Height of the image in pixels (default: 1024)
+            build_id (int): ID of the message that requested the build, to reuse a prefetched image
+            step_number (int): 1-based number of the step in that build, to reuse a prefetched image
             
         Returns:
-            dict: Response containing the generation ID or error message
+            dict: Response containing the generation ID or error message, or the URL of a cached image
         """
 
+        # Reuse the generation started by run() for this step, if there is one
+        pending = self._pending_images.pop((build_id, step_number), None)
+        if pending is not None:
+            return await pending
+
         # POST request to start image generation
  
         # Start the generation process
-        result, _ = await self._start_generation(IMAGE_STEP_PROMPT + " << " + prompt + " >>")
-        return result
+        return await self._generate_cached(_step_image_prompt(prompt))
+
+    async def generate_images_for_steps(self, steps):
+        """
+        Starts image generation for several instruction steps in parallel.
+
+        Args:
+            steps (list): The text of each step to illustrate
+
+        Returns:
+            list: One generate_image_step result per step, in the same order
+        """
+        return await asyncio.gather(*(self.generate_image_step(step) for step in steps))
 
     async def generate_image_elaborate(self, prompt, width=1024, height=1024):
         """
@@ -363,14 +933,13 @@ class BuilderAgent:
             height (int): Height of the image in pixels (default: 1024)
             
         Returns:
-            dict: Response containing the generation ID or error message
+            dict: Response containing the generation ID or error message, or the URL of a cached image
         """
 
         # POST request to start image generation
  
         # Start the generation process
-        result, _ = await self._start_generation(IMAGE_ELABORATION_PROMPT + " << " + prompt + " >>")
-        return result
+        return await self._generate_cached(f"{IMAGE_ELAB_PREFIX}{prompt}{IMAGE_SUFFIX}")
     
     async def check_image_status(self, generation_id):
         """
@@ -382,13 +951,51 @@ class BuilderAgent:
         Returns:
             dict: Response containing the generation status and result if available
         """
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f'https://api.us1.bfl.ai/v1/get_result?id={generation_id}',
-                headers={
-                    'accept': 'application/json',
-                    'x-key': os.environ.get('BFL_API_KEY'),
-                }
-            ) as response:
-                data = await response.json()
-                return data, 200
\ No newline at end of file
+        return await self._singleflight(
+            "status:" + generation_id, lambda: self._get_image_status(generation_id)
+        )
+
+    async def _get_image_status(self, generation_id):
+        response = await self._http.get("/get_result", params={'id': generation_id})
+        data = orjson.loads(response.content)
+        logger.debug("BFL status: %s", data)
+
+        if data.get('status') == 'Ready':
+            key = self._generation_keys.pop(generation_id, None)
+            if key is not None:
+                self._img_cache.set(key, data['result']['sample'])
+        elif data.get('status') in BFL_FAILED_STATUSES:
+            self._generation_keys.pop(generation_id, None)
+        return data, 200
+
+    async def wait_for_image(self, generation_id, max_wait=60, delay=0.2, multiplier=1.5, max_delay=2.0,
+                             jitter=0.1):
+        """
+        Polls a generation until it finishes, backing off exponentially between checks.
+
+        Args:
+            generation_id (str): The ID of the generation to wait for
+            max_wait (float): Maximum number of seconds to wait
+            delay (float): Seconds to wait before the second check
+            multiplier (float): Factor applied to the delay after every check
+            max_delay (float): Upper bound for the delay between checks
+            jitter (float): Each delay is randomly lengthened by up to this fraction, so that
+                            generations started together are not all polled at the same moment
+
+        Returns:
+            dict: The last status response. Its status is 'Ready' on success, one of
+                  BFL_FAILED_STATUSES if the generation failed, and anything else on a timeout.
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            data, _ = await self.check_image_status(generation_id)
+            if data.get('status') == 'Ready' or data.get('status') in BFL_FAILED_STATUSES:
+                return data
+
+            sleep = delay * (1 + random.uniform(0, jitter))
+            if time.monotonic() + sleep > deadline:
+                # Nothing polls the generation after a timeout, so its result won't be cached.
+                self._generation_keys.pop(generation_id, None)
+                return data
+            await asyncio.sleep(sleep)
+            delay = min(delay * multiplier, max_delay)
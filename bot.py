@@ -2,16 +2,34 @@ import os
 import discord
 import logging
 import asyncio
-import time
 
+from collections import deque
 from discord.ext import commands
 from dotenv import load_dotenv
-from agent import BuilderAgent
+from agent import BFL_FAILED_STATUSES, BuilderAgent, illustrated_step_indices
+from bot_text import bold_units_and_dimensions, partition_string, process_response
 
 # ylitchev: import the following so that regular expressions can be compiled and evaluated
 import re
 
 PREFIX = "!"
+# Messages starting with one of these are requests for Bob; everything else is ignored.
+PICTURE_TRIGGER = "Make me a picture"
+ELABORATION_TRIGGERS = ("Bob, please explain", "Bob, please elaborate")
+COST_TRIGGERS = ("Bob, estimate costs", "Bob, please estimate costs")
+TRIGGERS = ("Bob, please build", PICTURE_TRIGGER) + ELABORATION_TRIGGERS + COST_TRIGGERS
+
+# Elaboration requests about a step of the most recent build (group 2), or of a build N builds ago (group 3)
+_ELAB_RE = re.compile(
+    r"Bob, please (?:explain|elaborate).*?step (\d+).*?(?:(prev|past|last)|(\d+) (?:iteration|sequence|build))",
+    re.IGNORECASE,
+)
+# Cost estimate requests for a step of the most recent build, a build N builds ago, or a whole build
+_COST_RECENT_RE = re.compile(r"Bob, (please |)estimate costs.*?step (\d+).*?(prev|past|last)", re.IGNORECASE)
+_COST_PAST_RE = re.compile(
+    r"Bob, (please |)estimate costs.*?step (\d+).*?(\d+) (iteration|sequence|build)", re.IGNORECASE
+)
+_COST_ALL_RE = re.compile(r"Bob, (please |)estimate (total |all |)costs.*?(prev|past|last)", re.IGNORECASE)
 
 # Setup logging
 logger = logging.getLogger("discord")
@@ -22,7 +40,20 @@ load_dotenv()
 # Create the bot with all intents
 # The message content and members intent must be enabled in the Discord Developer Portal for the bot to work.
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix=PREFIX, intents=intents)
+
+
+class BuilderBot(commands.Bot):
+    async def setup_hook(self):
+        # Runs once before the bot connects to the gateway.
+        await agent.start()
+
+    async def close(self):
+        # Release the agent's pooled HTTP connections when the bot shuts down.
+        await agent.close()
+        await super().close()
+
+
+bot = BuilderBot(command_prefix=PREFIX, intents=intents)
 
 # Import the Mistral agent from the agent.py file
 agent = BuilderAgent()
@@ -36,119 +67,60 @@ token = os.getenv("DISCORD_TOKEN")
 def color_text(text, color_code):
     return f"\033[{color_code}m{text}\033[0m"
 
-# Bolds numbers followed by imperial/metric units and dimensions like 1x4 in the given text.
-def bold_units_and_dimensions(text):
-    pattern = re.compile(
-        # r'(\b\d{1,3}(?:,\d{3})*(?:\.\d+)?\s*(?:inches|inch|in|feet|foot|ft|yards|yd|miles|mile|mi|centimeters|cm|meters|m|kilometers|km)\b|\b\d+x\d+\b)',
-        r'(\b\d{1,3}(?:,\d{3})*(?:\.\d+)?\s*(?:-|)(?:inches|inch|in|feet|foot|ft|yards|yd|miles|mile|mi|centimeters|cm|meters|m|kilometers|km)\b|\b\d+x\d+\b)',
-        flags=re.IGNORECASE
-    )
-    return pattern.sub(r'**\1**', text)
-
-
-# Splits the text into sections starting with headers (####).
-# Each section includes the header and content until the next header.
-def split_into_sections(text):
-    lines = text.split('\n')
-    sections = []
-    current_section = []
-    step_pattern = re.compile(r'^#### Step \d+: ')
-    # step_pattern = re.compile(r'^(#### Step \d+: |\d+\. \*\*[^*]+?\*\*)')
-    
-    for line in lines:
-        if line.startswith('#### ') or step_pattern.match(line):
-            if current_section:
-                sections.append('\n'.join(current_section))
-                current_section = []
-            current_section.append(line)
-        else:
-            current_section.append(line)
-    if current_section:
-        sections.append('\n'.join(current_section))
-    return sections
-
-
-# ylitchev: overkill function that guarantees that messages sent to discord are less than
-#           2000 characters and that it does not break up a word
-def partition_string(text, max_chunk_size=1995):
+async def _generate_and_show(message: discord.Message, banner: str, generation):
     """
-    Partitions a string into chunks, maximizing chunk length up to a limit,
-    and only breaking at spaces.
-
-    Args:
-        text: The input string.
-        max_chunk_size: The maximum size of each chunk.
-
-    Returns:
-        A list of string chunks.  Returns an empty list if the input
-        string is empty or None.
-    """
-
-    if not text: # Check for empty or None input
-        return []
-
-    partitions = []
-    current_chunk = ""
-    words = text.split(" ")  # Split the string into words
-
-    for word in words:
-        potential_chunk = current_chunk + (word if not current_chunk else " " + word) # Add a space if it is not the first word
-        if len(potential_chunk) <= max_chunk_size:
-            current_chunk = potential_chunk
-        else:
-            partitions.append(current_chunk)
-            current_chunk = word  # Start a new chunk with the current word
-
-    if current_chunk:  # Add the last chunk if it's not empty
-        partitions.append(current_chunk)
-
-    return partitions
-
-async def generate_and_show_image(message: discord.Message, prompt: str):
-    """ 
-    Uses agent to generate an image. Waits until the image is ready. Then renders it in the channel.
+    Replies with a status message, waits for an image generation, then renders the image in the channel.
+    The status message is kept up to date along the way.
 
     Args:
         message (discord.Message): The message that initiated the image generation
-        prompt (str): The text prompt for image generation
+        banner (str): The initial text of the status message
+        generation: Awaitable of one of the agent.generate_image* methods, resolving to an error,
+                    the URL of a recently generated image, or a generation ID
 
     Returns:
         None
     """
     # Send initial response
-    status_message = await message.reply(f"Starting image generation for: '{prompt}'...")
+    status_message = await message.reply(banner)
 
     # Start the image generation process
-    generation_result = await agent.generate_image(prompt)
+    generation_result = await generation
 
     if 'error' in generation_result:
         await status_message.edit(content=f"Error starting image generation: {generation_result['error']}")
         return
 
+    # The same image was generated recently, no need to wait for a new one
+    if 'url' in generation_result:
+        embed = discord.Embed(title="Generated Image")
+        embed.set_image(url=generation_result['url'])
+        await message.channel.send(embed=embed)
+        await status_message.edit(content=f"Image generation complete!")
+        return
+
     generation_id = generation_result['id']
     await status_message.edit(content=f"Image generation in progress (ID: {generation_id})...")
 
-    start_time = time.time()
-    max_wait_time = 30 
-
-    while time.time() - start_time < max_wait_time:
-        status_result, status_code = await agent.check_image_status(generation_id)
-        print(f"Status check result: {status_result}")
-        if status_result.get('status', '') == 'Ready':
-            embed = discord.Embed(title="Generated Image")
-            embed.set_image(url=status_result['result']['sample'])
-            await message.channel.send(embed=embed)
-            await status_message.edit(content=f"Image generation complete!")
-            return
+    status_result = await agent.wait_for_image(generation_id, max_wait=30)
+    logger.debug("Status check result: %s", status_result)
+    if status_result.get('status', '') == 'Ready':
+        embed = discord.Embed(title="Generated Image")
+        embed.set_image(url=status_result['result']['sample'])
+        await message.channel.send(embed=embed)
+        await status_message.edit(content=f"Image generation complete!")
+        return
 
-        await asyncio.sleep(1)
+    if status_result.get('status', '') in BFL_FAILED_STATUSES:
+        await status_message.edit(content=f"Image generation failed: {status_result['status']}")
+        return
 
     await status_message.edit(content="Image generation timed out. Please try again later.")
     return
 
-async def generate_step_image(message: discord.Message, prompt: str):
+async def generate_and_show_image(message: discord.Message, prompt: str):
     """ 
-    Uses agent to generate an image for an instruction step. Waits until the image is ready. Then renders it in the channel.
+    Uses agent to generate an image. Waits until the image is ready. Then renders it in the channel.
 
     Args:
         message (discord.Message): The message that initiated the image generation
@@ -157,79 +129,42 @@ async def generate_step_image(message: discord.Message, prompt: str):
     Returns:
         None
     """
-    # Send initial response
-    status_message = await message.reply(f"Starting image generation for this step...")
+    await _generate_and_show(message, f"Starting image generation for: '{prompt}'...", agent.generate_image(prompt))
 
-    # Start the image generation process
-    generation_result = await agent.generate_image_step(prompt)
-
-    if 'error' in generation_result:
-        await status_message.edit(content=f"Error starting image generation: {generation_result['error']}")
-        return
-
-    generation_id = generation_result['id']
-    await status_message.edit(content=f"Image generation in progress (ID: {generation_id})...")
-
-    start_time = time.time()
-    max_wait_time = 30 
-
-    while time.time() - start_time < max_wait_time:
-        status_result, status_code = await agent.check_image_status(generation_id)
-        print(f"Status check result: {status_result}")
-        if status_result.get('status', '') == 'Ready':
-            embed = discord.Embed(title="Generated Image")
-            embed.set_image(url=status_result['result']['sample'])
-            await message.channel.send(embed=embed)
-            await status_message.edit(content=f"Image generation complete!")
-            return
+async def generate_step_image(message: discord.Message, prompt: str, step_number: int = None):
+    """ 
+    Uses agent to generate an image for an instruction step. Waits until the image is ready. Then renders it in the channel.
 
-        await asyncio.sleep(1)
+    Args:
+        message (discord.Message): The message that initiated the image generation
+        prompt (str): The text prompt for image generation
+        step_number (int): 1-based number of the step, so the agent can reuse a prefetched image
 
-    await status_message.edit(content="Image generation timed out. Please try again later.")
-    return
+    Returns:
+        None
+    """
+    await _generate_and_show(
+        message, "Starting image generation for this step...",
+        agent.generate_image_step(prompt, build_id=message.id, step_number=step_number),
+    )
     
     
-async def generate_elaboration_image(message: discord.Message, prompt: str):
+async def generate_elaboration_image(message: discord.Message, prompt: str, generation=None):
     """ 
     Uses agent to generate an image for elaborating on steps. Waits until the image is ready. Then renders it in the channel.
 
     Args:
         message (discord.Message): The message that initiated the image generation
         prompt (str): The text prompt for image generation
+        generation: Task of an agent.generate_image_elaborate(prompt) call that was already started, if any
 
     Returns:
         None
     """
-    # Send initial response
-    status_message = await message.reply(f"Starting image generation for elaborated steps...")
-
-    # Start the image generation process
-    generation_result = await agent.generate_image_elaborate(prompt)
-
-    if 'error' in generation_result:
-        await status_message.edit(content=f"Error starting image generation: {generation_result['error']}")
-        return
-
-    generation_id = generation_result['id']
-    await status_message.edit(content=f"Image generation in progress (ID: {generation_id})...")
-
-    start_time = time.time()
-    max_wait_time = 30 
-
-    while time.time() - start_time < max_wait_time:
-        status_result, status_code = await agent.check_image_status(generation_id)
-        print(f"Status check result: {status_result}")
-        if status_result.get('status', '') == 'Ready':
-            embed = discord.Embed(title="Generated Image")
-            embed.set_image(url=status_result['result']['sample'])
-            await message.channel.send(embed=embed)
-            await status_message.edit(content=f"Image generation complete!")
-            return
-
-        await asyncio.sleep(1)
-
-    await status_message.edit(content="Image generation timed out. Please try again later.")
-    return
+    # The generation may already have been started
+    if generation is None:
+        generation = agent.generate_image_elaborate(prompt)
+    await _generate_and_show(message, "Starting image generation for elaborated steps...", generation)
 
 @bot.event
 async def on_ready():
@@ -239,53 +174,41 @@ async def on_ready():
 
     https://discordpy.readthedocs.io/en/latest/api.html#discord.on_ready
     """
-    logger.info(f"{bot.user} has connected to Discord!")
+    logger.info("%s has connected to Discord!", bot.user)
 
 
 
 
 #############################        CACHE SETUP        #############################
 
-message_history = {}
-head_index = 0
+# The steps of the most recent builds, oldest first. Appending a build beyond MAX_HISTORY_LEN drops the oldest.
 MAX_HISTORY_LEN = 10
+message_history = deque(maxlen=MAX_HISTORY_LEN)
 
 #############################        CACHE SETUP        #############################
 
 
 
-def increment_head_index():
-    global head_index       # We wish to declare that we are modifying the global occurence
-                            # of head_index in this function
-    head_index = (head_index + 1) % MAX_HISTORY_LEN
-
 @bot.event
 async def on_message(message: discord.Message):
-    print(message.content)
     """
     Called when a message is sent in any channel the bot can see.
 
     https://discordpy.readthedocs.io/en/latest/api.html#discord.on_message
     """
+    content = message.content
+    logger.debug("Message received: %s", content)
+
     # Don't delete this line! It's necessary for the bot to process commands.
     await bot.process_commands(message)
 
-    # Ignore messages from self or other bots.
-    if (
-        message.author == bot.user
-        or message.author.bot
-        or message.content.startswith("!")
-        or not (message.content.startswith("Bob, please build") or message.content.startswith("Make me a picture")
-                or message.content.startswith("Bob, please explain") or message.content.startswith("Bob, please elaborate")
-                or message.content.startswith("Bob, estimate costs") or message.content.startswith("Bob, please estimate costs"))
-        # or not (message.content.startswith("Bob, please explain") or message.content.startswith("Bob, please elaborate"))
-    ):
+    # Ignore messages from self or other bots, commands, and messages that are not meant for Bob.
+    author = message.author
+    if author.bot or author == bot.user or content.startswith(PREFIX) or not content.startswith(TRIGGERS):
         return
     
     # Check if we have cached message history, if so, we want to check if we need to elaborate on the prompt
     
-    global head_index       # We wish to declare that we are modifying the global occurence
-                            # of head_index in this function
     if message_history:
         # requesting_elaboration = await check_if_requesting_elaboration()
         # if requesting_elaboration.lower().startswith("y"):
@@ -295,184 +218,145 @@ async def on_message(message: discord.Message):
         #         requesting_elaboration_on_this_section = await requesting_elaboration_section()
         #         if requesting_elaboration_on_this_section
 
-        # Regex to see if we are looking for the most recent build
-        requesting_elaboration = r"Bob, please (explain|elaborate).*?step (\d+).*?(prev|past|last)"
-        matches = re.findall(requesting_elaboration, message.content, re.IGNORECASE)
-        if matches:
-            # Extract the step we are looking for
-            step_ID = int(matches[0][1])
-            print(step_ID)
-
-            # Do bounds checks
-            if step_ID < 1 or step_ID > len(message_history[(head_index + MAX_HISTORY_LEN - 1) % MAX_HISTORY_LEN]) : 
-                print("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
-                await message.reply("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
-                return
-            
-            # Obtain an elaboration response
-            response = await agent.elaborate(message, step_ID, 1, message_history[(head_index + MAX_HISTORY_LEN - 1) % MAX_HISTORY_LEN])
-
-            # Process response, exactly the same way as with regular responses (bold units, separate replies by step, etc)
-            processed_response = bold_units_and_dimensions(response)
-            sections = split_into_sections(processed_response)
-
-            step_pattern = re.compile(r'^#### Step \d+: ')
-            
-            for section in sections:
-                if section.strip():  # Avoid empty messages
-                    section_with_newline = section
-                    partitioned_text = partition_string(section_with_newline)
-                    for partition in partitioned_text:
-                        await message.reply(partition)
-                    if step_pattern.match(section):
-                        continue
-            
-            # Generate a helpful image for the elaborated step description
-            await generate_elaboration_image(message, response)
-
-            return
-        else:
-            # We might be looking for a build further back in time. We use a regex to extract the step
-            # number, and however many builds ago we are looking for
-            requesting_elaboration = r"Bob, please (explain|elaborate).*?step (\d+).*?(\d+) (iteration|sequence|build)"
-            matches = re.findall(requesting_elaboration, message.content, re.IGNORECASE)
-            if matches:
+        # Only the patterns for the kind of request the message starts with are tried.
+        if content.startswith(ELABORATION_TRIGGERS):
+            # Regex to find the step we are looking for, and whether it is in the most recent build
+            # (prev|past|last) or in a build further back in time (however many builds ago)
+            match = _ELAB_RE.search(content)
+            if match:
                 # Get the steps number and build index
-                step_ID, build_past_iter = int(matches[0][1]), int(matches[0][2])
-                build_index = (head_index + MAX_HISTORY_LEN - build_past_iter) % MAX_HISTORY_LEN
+                step_ID = int(match.group(1))
+                build_past_iter = 1 if match.group(2) else int(match.group(3))
+                logger.debug("Elaboration requested for step %d, %d builds ago", step_ID, build_past_iter)
 
                 # Check the build index actually exists and we are not too far back in time
-                if build_index not in message_history or build_past_iter > MAX_HISTORY_LEN :
-                    print(f"You are requesting a build that is not in recent memory, you can at most request {MAX_HISTORY_LEN} builds ago")
+                if build_past_iter < 1 or build_past_iter > len(message_history) :
+                    logger.debug("Requested build %d builds ago is not in the history", build_past_iter)
                     await message.reply(f"You are requesting a build that is not in recent memory, you can at most request {MAX_HISTORY_LEN} builds ago")
                     return
                 
                 # Do bounds checks
-                if step_ID < 1 or step_ID > len(message_history[build_index]) : 
-                    print("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
+                if step_ID < 1 or step_ID > len(message_history[-build_past_iter]) : 
+                    logger.debug("Requested step %d is out of range", step_ID)
                     await message.reply("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
                     return
                 
                 # Obtain an elaboration response
-                response = await agent.elaborate(message, step_ID, build_past_iter, message_history[build_index])
+                response = await agent.elaborate(message, step_ID, build_past_iter, message_history[-build_past_iter])
+
+                # Discord shows replies in the order they arrive, so they have to be sent one at a time. The
+                # image is generated in the meantime.
+                generation = asyncio.create_task(agent.generate_image_elaborate(response))
 
                 # Process response, exactly the same way as with regular responses (bold units, separate replies by step, etc)
-                processed_response = bold_units_and_dimensions(response)
-                sections = split_into_sections(processed_response)
+                sections = process_response(response)
 
-                step_pattern = re.compile(r'^#### Step \d+: ')
-                
-                for section in sections:
+                for _, section in sections:
                     if section.strip():  # Avoid empty messages
                         section_with_newline = section
                         partitioned_text = partition_string(section_with_newline)
                         for partition in partitioned_text:
                             await message.reply(partition)
-                        if step_pattern.match(section):
-                            continue
                 
                 # Generate a helpful image for the elaborated step description
-                await generate_elaboration_image(message, response)
-
-                return
+                await generate_elaboration_image(message, response, generation)
 
-        # Check for cost estimation requests for the most recent build
-        requesting_cost_estimate = r"Bob, (please |)estimate costs.*?step (\d+).*?(prev|past|last)"
-        matches = re.findall(requesting_cost_estimate, message.content, re.IGNORECASE)
-        if matches:
-            # Extract the step we are looking for
-            step_ID = int(matches[0][1])
-            print(f"Cost estimate requested for step {step_ID}")
-
-            # Do bounds checks
-            if step_ID < 1 or step_ID > len(message_history[(head_index + MAX_HISTORY_LEN - 1) % MAX_HISTORY_LEN]) : 
-                print("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
-                await message.reply("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
                 return
-            
-            # Obtain a cost estimate response
-            response = await agent.estimate_costs(message, step_ID, 1, message_history[(head_index + MAX_HISTORY_LEN - 1) % MAX_HISTORY_LEN])
 
-            # Process response, bold units and dimensions
-            processed_response = bold_units_and_dimensions(response)
-            
-            # Send the cost estimate as a reply
-            partitioned_text = partition_string(processed_response)
-            for partition in partitioned_text:
-                await message.reply(partition)
-            
-            return
-        else:
-            # We might be looking for a cost estimate for a build further back in time
-            requesting_cost_estimate = r"Bob, (please |)estimate costs.*?step (\d+).*?(\d+) (iteration|sequence|build)"
-            matches = re.findall(requesting_cost_estimate, message.content, re.IGNORECASE)
-            if matches:
-                # Get the step number and build index
-                step_ID, build_past_iter = int(matches[0][1]), int(matches[0][2])
-                build_index = (head_index + MAX_HISTORY_LEN - build_past_iter) % MAX_HISTORY_LEN
+        if content.startswith(COST_TRIGGERS):
+            # Check for cost estimation requests for the most recent build
+            match = _COST_RECENT_RE.search(content)
+            if match:
+                # Extract the step we are looking for
+                step_ID = int(match.group(2))
+                logger.debug("Cost estimate requested for step %d", step_ID)
 
-                # Check the build index actually exists and we are not too far back in time
-                if build_index not in message_history or build_past_iter > MAX_HISTORY_LEN :
-                    print(f"You are requesting a build that is not in recent memory, you can at most request {MAX_HISTORY_LEN} builds ago")
-                    await message.reply(f"You are requesting a build that is not in recent memory, you can at most request {MAX_HISTORY_LEN} builds ago")
-                    return
-                
                 # Do bounds checks
-                if step_ID < 1 or step_ID > len(message_history[build_index]) : 
-                    print("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
+                if step_ID < 1 or step_ID > len(message_history[-1]) : 
+                    logger.debug("Requested step %d is out of range", step_ID)
                     await message.reply("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
                     return
-                
+            
                 # Obtain a cost estimate response
-                response = await agent.estimate_costs(message, step_ID, build_past_iter, message_history[build_index])
+                response = await agent.estimate_costs(message, step_ID, 1, message_history[-1])
 
                 # Process response, bold units and dimensions
                 processed_response = bold_units_and_dimensions(response)
-                
+            
                 # Send the cost estimate as a reply
                 partitioned_text = partition_string(processed_response)
                 for partition in partitioned_text:
                     await message.reply(partition)
-                
+            
                 return
+            else:
+                # We might be looking for a cost estimate for a build further back in time
+                match = _COST_PAST_RE.search(content)
+                if match:
+                    # Get the step number and build index
+                    step_ID, build_past_iter = int(match.group(2)), int(match.group(3))
+
+                    # Check the build index actually exists and we are not too far back in time
+                    if build_past_iter < 1 or build_past_iter > len(message_history) :
+                        logger.debug("Requested build %d builds ago is not in the history", build_past_iter)
+                        await message.reply(f"You are requesting a build that is not in recent memory, you can at most request {MAX_HISTORY_LEN} builds ago")
+                        return
+                
+                    # Do bounds checks
+                    if step_ID < 1 or step_ID > len(message_history[-build_past_iter]) : 
+                        logger.debug("Requested step %d is out of range", step_ID)
+                        await message.reply("Error, the step seems to be too big or small, make sure it is in range of the listed steps")
+                        return
+                
+                    # Obtain a cost estimate response
+                    response = await agent.estimate_costs(message, step_ID, build_past_iter, message_history[-build_past_iter])
+
+                    # Process response, bold units and dimensions
+                    processed_response = bold_units_and_dimensions(response)
+                
+                    # Send the cost estimate as a reply
+                    partitioned_text = partition_string(processed_response)
+                    for partition in partitioned_text:
+                        await message.reply(partition)
+                
+                    return
         
-        # Check for cost estimation for all materials in the most recent build
-        requesting_full_cost_estimate = r"Bob, (please |)estimate (total |all |)costs.*?(prev|past|last)"
-        matches = re.findall(requesting_full_cost_estimate, message.content, re.IGNORECASE)
-        if matches:
-            # Get all steps from the most recent build
-            all_steps = message_history[(head_index + MAX_HISTORY_LEN - 1) % MAX_HISTORY_LEN]
-            if not all_steps:
-                await message.reply("No recent build found to estimate costs for.")
-                return
+            # Check for cost estimation for all materials in the most recent build
+            match = _COST_ALL_RE.search(content)
+            if match:
+                # Get all steps from the most recent build
+                all_steps = message_history[-1]
+                if not all_steps:
+                    await message.reply("No recent build found to estimate costs for.")
+                    return
                 
-            # Combine all steps into one string for the materials section
-            combined_steps = "\n".join(all_steps)
+                # Combine all steps into one string for the materials section
+                combined_steps = "\n".join(all_steps)
             
-            # Get the materials section from the combined steps
-            materials_section = ""
-            if "Materials:" in combined_steps:
-                materials_section = combined_steps.split("Materials:")[1].split("Tools:")[0]
+                # Get the materials section from the combined steps
+                materials_section = ""
+                if "Materials:" in combined_steps:
+                    materials_section = combined_steps.split("Materials:")[1].split("Tools:")[0]
             
-            if not materials_section:
-                await message.reply("Could not find materials section in the build.")
-                return
+                if not materials_section:
+                    await message.reply("Could not find materials section in the build.")
+                    return
                 
-            # Format the materials section for cost estimation
-            formatted_materials = f"Materials:\n{materials_section}"
+                # Format the materials section for cost estimation
+                formatted_materials = f"Materials:\n{materials_section}"
             
-            # Obtain a cost estimate response for all materials
-            response = await agent.get_cost_estimate(message, formatted_materials, combined_steps)
+                # Obtain a cost estimate response for all materials
+                response = await agent.get_cost_estimate(message, formatted_materials, combined_steps)
             
-            # Process response, bold units and dimensions
-            processed_response = bold_units_and_dimensions(response)
+                # Process response, bold units and dimensions
+                processed_response = bold_units_and_dimensions(response)
             
-            # Send the cost estimate as a reply
-            partitioned_text = partition_string(processed_response)
-            for partition in partitioned_text:
-                await message.reply(partition)
+                # Send the cost estimate as a reply
+                partitioned_text = partition_string(processed_response)
+                for partition in partitioned_text:
+                    await message.reply(partition)
                 
-            return
+                return
 
         # return [int(match[1]) for match in matches]
 
@@ -480,21 +364,17 @@ async def on_message(message: discord.Message):
 
     # TODO: Improve the logic/interface of when to generate an image. Probably want to integrate with Bob, so its
     # not just when someone asks "Make me a picture"
-    if message.content.startswith("Make me a picture"):
+    if content.startswith(PICTURE_TRIGGER):
         # Extract the prompt from the message
-        prompt = message.content.replace("Make me a picture", "").strip()
+        prompt = content[len(PICTURE_TRIGGER):].strip()
         if not prompt:
             prompt = "A beautiful landscape"  # Default prompt if none provided
         await generate_and_show_image(message, prompt)
         return
 
-    # Ignore messages from self or other bots to prevent infinite loops.
-    if message.author.bot or message.content.startswith("!"):
-        return
-
     # Process the message with the agent you wrote
     # Open up the agent.py file to customize the agent
-    logger.info(f"Processing message from {message.author}: {message.content}")
+    logger.info("Processing message from %s: %s", author, content)
     response = await agent.run(message)
 
     # If response is None, the request was not reasonable.
@@ -509,46 +389,49 @@ async def on_message(message: discord.Message):
     
     # response = response + test
 
-    # Bold units and dimensions
-    processed_response = bold_units_and_dimensions(response)
-
-    # Split into sections
-    sections = split_into_sections(processed_response)
+    # Bold units and dimensions and split into sections
+    sections = list(process_response(response))
 
     # Collect steps (#### Step N: ...)
-    steps_list = []
-    step_pattern = re.compile(r'^#### Step \d+: ')
-    # step_pattern = re.compile(r'^(#### Step \d+: |\d+\. \*\*[^*]+?\*\*)')
-    for section in sections:
-        lines = section.split('\n')
-        if lines and step_pattern.match(lines[0]):
-            steps_list.append(section)
-
-    # Send each section as a separate reply
-    for section in sections:
-        if section.strip():  # Avoid empty messages
-            section_with_newline = section
-            partitioned_text = partition_string(section_with_newline)
-            for partition in partitioned_text:
-                await message.reply(partition)
-
-            # GENERATE AT MOST 3 IMAGES: START, MIDDLE, AND END
-            if section == steps_list[0]:
-                await generate_step_image(message, section)
-            elif len(steps_list) > 2 and section == steps_list[len(steps_list)//2] :
-                await generate_step_image(message, section)
-            elif len(steps_list) > 1 and section == steps_list[len(steps_list) - 1] :
-                await generate_step_image(message, section)
-                
-                # continue
-                # Insert function here to generate image for a particular step
-                # print ("Making an image for step: " + section)
-            
-            # await message.reply(section_with_newline)
-    message_history[head_index] = steps_list
-    increment_head_index()
+    steps_list = [section for is_step, section in sections if is_step]
+
+    # Send each section as a separate reply. The replies are sent one at a time because Discord shows
+    # them in the order they arrive, but step images are only started here: waiting for each image
+    # before sending the next step would hold up the rest of the instructions for several seconds.
+    image_tasks = []
+    # GENERATE AT MOST 3 IMAGES: START, MIDDLE, AND END (the same steps the agent prefetched images for)
+    illustrated = frozenset(illustrated_step_indices(len(steps_list)))
+    step_index = -1
+    try:
+        for is_step, section in sections:
+            if is_step:
+                step_index += 1
+            if section.strip():  # Avoid empty messages
+                section_with_newline = section
+                partitioned_text = partition_string(section_with_newline)
+                for partition in partitioned_text:
+                    await message.reply(partition)
 
-    print(message_history)
+                if is_step and step_index in illustrated:
+                    image_tasks.append(asyncio.create_task(generate_step_image(message, section, step_index + 1)))
+                    
+                    # continue
+                    # Insert function here to generate image for a particular step
+                    # print ("Making an image for step: " + section)
+                
+                # await message.reply(section_with_newline)
+        message_history.append(steps_list)
+
+        # One failed image shouldn't hide the others, so every failure is logged on its own.
+        for result in await asyncio.gather(*image_tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Step image generation failed", exc_info=result)
+    finally:
+        # Images prefetched for steps that did not end up illustrated are no longer needed, also when
+        # sending a reply failed part way through.
+        agent.cancel_prefetched_images(message.id)
+
+    logger.debug("Message history: %s", message_history)
     # await message.reply(response)
     
 
@@ -567,5 +450,28 @@ async def ping(ctx, *, arg=None):
         await ctx.send(f"Pong! Your argument was {arg}")
 
 
-# Start the bot, connecting it to the gateway
-bot.run(token)
+# Reports how well the agent's response cache is doing.
+@bot.command(name="cachestats", help="Shows the agent's response cache statistics.")
+async def cachestats(ctx):
+    stats = agent.cache.stats()
+    await ctx.send(
+        f"Cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"({stats['hit_rate']:.0%} hit rate), {stats['size']} entries"
+    )
+
+
+async def main():
+    # Run the bot in our own event loop instead of through bot.run(), so startup work can be awaited
+    # before the bot connects. Logging is set up the way bot.run() does it: only for the discord logger,
+    # so e.g. httpx doesn't log every request at INFO.
+    discord.utils.setup_logging(root=False)
+    async with bot:
+        await bot.start(token)
+
+
+# Start the bot, connecting it to the gateway. Ctrl-C cancels main(), which closes the bot (and with
+# it the agent) on its way out, so it only has to be kept from printing a traceback, like bot.run() does.
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
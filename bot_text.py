@@ -0,0 +1,91 @@
+import re
+from collections.abc import Iterator
+
+# Text processing for the bot's replies. These helpers run on every response, so they are kept free of
+# Discord and bot state, and fully annotated so the module can be compiled with mypyc (`mypyc bot_text.py`).
+
+# Regular expressions used on every response, compiled once at import time.
+# Numbers followed by imperial/metric units, and dimensions like 1x4
+_UNITS_RE = re.compile(
+    # r'(\b\d{1,3}(?:,\d{3})*(?:\.\d+)?\s*(?:inches|inch|in|feet|foot|ft|yards|yd|miles|mile|mi|centimeters|cm|meters|m|kilometers|km)\b|\b\d+x\d+\b)',
+    r'(\b\d{1,3}(?:,\d{3})*(?:\.\d+)?\s*(?:-|)(?:inches|inch|in|feet|foot|ft|yards|yd|miles|mile|mi|centimeters|cm|meters|m|kilometers|km)\b|\b\d+x\d+\b)',
+    flags=re.IGNORECASE
+)
+# The words partition_string may break between
+_WORD_RE = re.compile(r'[^ ]+')
+# Every _UNITS_RE match contains a digit, so text without one can be skipped
+_HAS_DIGIT_RE = re.compile(r'\d')
+# Step headers (#### Step N: ...)
+_STEP_RE = re.compile(r'^#### Step \d+: ')
+# _STEP_RE = re.compile(r'^(#### Step \d+: |\d+\. \*\*[^*]+?\*\*)')
+
+
+# Bolds numbers followed by imperial/metric units and dimensions like 1x4 in the given text.
+def bold_units_and_dimensions(text: str) -> str:
+    if not _HAS_DIGIT_RE.search(text):
+        return text
+    return _UNITS_RE.sub(r'**\1**', text)
+
+
+# Bolds units and dimensions and splits the text into sections starting with headers (####), in a
+# single pass over the lines. Each section includes the header and content until the next header.
+# Yields (is_step, section) pairs, where is_step tells whether the section starts with a step header.
+def process_response(text: str) -> Iterator[tuple[bool, str]]:
+    current_section: list[str] = []
+    is_step = False
+
+    for line in text.splitlines():
+        # Every step header (_STEP_RE) also starts with '#### ', so the regex only runs on headers.
+        if line.startswith('#### '):
+            if current_section:
+                yield is_step, '\n'.join(current_section)
+                current_section = []
+            is_step = _STEP_RE.match(line) is not None
+        current_section.append(_UNITS_RE.sub(r'**\1**', line) if _HAS_DIGIT_RE.search(line) else line)
+    if current_section:
+        yield is_step, '\n'.join(current_section)
+
+
+# ylitchev: overkill function that guarantees that messages sent to discord are less than
+#           2000 characters and that it does not break up a word
+def partition_string(text: str | None, max_chunk_size: int = 1995) -> list[str]:
+    """
+    Partitions a string into chunks, maximizing chunk length up to a limit,
+    and only breaking at spaces.
+
+    Args:
+        text: The input string.
+        max_chunk_size: The maximum size of each chunk.
+
+    Returns:
+        A list of string chunks.  Returns an empty list if the input
+        string is empty or None.
+    """
+
+    if not text: # Check for empty or None input
+        return []
+
+    # Most sections fit in a single message. Unless it starts with a space (which the loop below
+    # drops), such a text comes back unchanged, so there's no need to split it into words.
+    if len(text) <= max_chunk_size and text[0] != " ":
+        return [text]
+
+    partitions: list[str] = []
+
+    # Walk over the words one at a time instead of splitting the whole text into a list up front, and
+    # slice each chunk out of the text once it is complete. chunk_start is -1 until the first word.
+    chunk_start = -1
+    chunk_end = 0
+    for word in _WORD_RE.finditer(text):
+        word_start, word_end = word.span()
+        if chunk_start < 0:
+            chunk_start = word_start
+        elif word_end - chunk_start > max_chunk_size:
+            partitions.append(text[chunk_start:chunk_end])
+            chunk_start = word_start  # Start a new chunk with the current word
+        chunk_end = word_end
+
+    if chunk_start >= 0:  # Add the last chunk if it's not empty
+        partitions.append(text[chunk_start:chunk_end])
+
+    return partitions
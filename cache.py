@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+# The semantic cache needs sentence-transformers (which brings numpy along). It is optional: without
+# it the semantic tier simply never hits.
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+logger = logging.getLogger("discord")
+
+
+class LLMCache:
+    """
+    In-memory exact-match cache for LLM responses with LRU eviction and a TTL.
+
+    Keys are expected to be hashes of everything that determines the response
+    (model, system prompt, user content), so a hit can be returned as-is.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """
+        Looks up a cached response.
+
+        Args:
+            key (str): The cache key
+
+        Returns:
+            str: The cached response, or None on a miss or an expired entry
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Stores a response, evicting the least recently used entry if the cache is full.
+
+        Args:
+            key (str): The cache key
+            value (str): The response to cache
+        """
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss counters, hit rate and current size of the cache
+        """
+        lookups = self._hits + self._misses
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': self._hits / lookups if lookups else 0.0,
+            'size': len(self._entries),
+        }
+
+
+class _SemanticNamespace:
+    """
+    The entries of one SemanticCache namespace. Embeddings are rows of a preallocated matrix that grows
+    geometrically, so adding an entry doesn't copy all the others.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.matrix = None      # (capacity, dim) float16 embeddings, rows [0, size) in use
+        self.created = None     # Wall-clock creation time of each row, for the TTL
+        self.last_used = None   # Monotonic time each row was last added or hit, for LRU eviction
+        self.rowids = []        # SQLite rowid of each row
+        self.responses = []
+
+    def append(self, rowid, embedding, response, created, maxsize):
+        if self.matrix is None:
+            capacity = min(64, maxsize)
+            self.matrix = np.empty((capacity, embedding.shape[0]), dtype=np.float16)
+            self.created = np.empty(capacity)
+            self.last_used = np.empty(capacity)
+        elif self.size == len(self.matrix):
+            capacity = min(2 * len(self.matrix), maxsize)
+            self.matrix = np.resize(self.matrix, (capacity, self.matrix.shape[1]))
+            self.created = np.resize(self.created, capacity)
+            self.last_used = np.resize(self.last_used, capacity)
+
+        i = self.size
+        self.matrix[i] = embedding
+        self.created[i] = created
+        self.last_used[i] = time.monotonic()
+        self.rowids.append(rowid)
+        self.responses.append(response)
+        self.size += 1
+
+    def remove(self, i):
+        """
+        Removes row i by moving the last row into its place.
+
+        Returns:
+            int: The SQLite rowid of the removed entry
+        """
+        last = self.size - 1
+        rowid = self.rowids[i]
+        if i != last:
+            self.matrix[i] = self.matrix[last]
+            self.created[i] = self.created[last]
+            self.last_used[i] = self.last_used[last]
+            self.rowids[i] = self.rowids[last]
+            self.responses[i] = self.responses[last]
+        self.rowids.pop()
+        self.responses.pop()
+        self.size = last
+        return rowid
+
+    def expired(self, cutoff):
+        """
+        Returns:
+            list: Indices of the rows created before `cutoff`, highest first so they can be removed in order
+        """
+        return sorted(np.flatnonzero(self.created[:self.size] < cutoff).tolist(), reverse=True)
+
+
+class SemanticCache:
+    """
+    Cache tier that matches paraphrased requests ("build a chair" vs "make me a chair") by cosine
+    similarity of MiniLM sentence embeddings.
+
+    Entries are grouped into namespaces (one per system prompt) so that an answer to one prompt is
+    never served for another. Embeddings are kept as float16 in memory and
+    persisted to SQLite so the cache survives restarts. Like LLMCache, each namespace holds at most
+    `maxsize` entries (least recently used ones are evicted first) and entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, path="semantic_cache.db", threshold=0.92, model_name=EMBEDDING_MODEL, maxsize=1024,
+                 ttl=24 * 3600):
+        self.threshold = threshold
+        self.model_name = model_name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = SentenceTransformer is not None
+        self._model = None
+        self._namespaces = {}
+        self._db = None
+
+        if not self.enabled:
+            return
+
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (namespace TEXT, embedding BLOB, response TEXT, ts INTEGER)"
+        )
+        # Databases written before entries expired have no ts column; their entries count as expired.
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+        if "ts" not in columns:
+            self._db.execute("ALTER TABLE entries ADD COLUMN ts INTEGER DEFAULT 0")
+        self._db.execute("DELETE FROM entries WHERE ts < ?", (self._cutoff(),))
+
+        evicted = []
+        rows = self._db.execute("SELECT rowid, namespace, embedding, response, ts FROM entries ORDER BY ts")
+        for rowid, namespace, blob, response, ts in rows.fetchall():
+            entries = self._namespaces.setdefault(namespace, _SemanticNamespace())
+            if entries.size >= self.maxsize:
+                # Rows are loaded oldest first, so the oldest entry is the least recently used one.
+                evicted.append(entries.remove(int(np.argmin(entries.last_used[:entries.size]))))
+            entries.append(rowid, np.frombuffer(blob, dtype=np.float16), response, ts, self.maxsize)
+        self._delete(evicted)
+        self._db.commit()
+
+    def close(self):
+        """
+        Closes the database. Call this once when shutting down.
+        """
+        if self._db is not None:
+            self._db.close()
+
+    def _cutoff(self):
+        return int(time.time()) - self.ttl
+
+    def _delete(self, rowids):
+        if rowids:
+            self._db.executemany("DELETE FROM entries WHERE rowid = ?", [(rowid,) for rowid in rowids])
+
+    def _disable(self, error):
+        # The semantic tier is optional: if the model can't be loaded (e.g. offline with nothing in the
+        # HuggingFace cache) or used, requests just miss it from then on.
+        if self.enabled:
+            logger.warning("Semantic cache disabled: %r", error)
+            self.enabled = False
+
+    def _load_model(self):
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def _encode(self, text):
+        # The model is loaded the first time it is needed unless load_model() was called, since it
+        # takes a while.
+        return self._load_model().encode(text, normalize_embeddings=True).astype(np.float16)
+
+    async def load_model(self):
+        """
+        Loads the embedding model without blocking the event loop, so the first lookup doesn't have to.
+        Does nothing if the semantic cache is disabled, and disables it if the model fails to load.
+        """
+        if not self.enabled:
+            return
+        try:
+            await asyncio.to_thread(self._load_model)
+        except Exception as e:
+            self._disable(e)
+
+    async def embed(self, text):
+        """
+        Embeds text without blocking the event loop.
+
+        Returns:
+            The normalized embedding, or None if the semantic cache is disabled or embedding failed
+            (which disables it)
+        """
+        if not self.enabled:
+            return None
+        try:
+            return await asyncio.to_thread(self._encode, text)
+        except Exception as e:
+            self._disable(e)
+            return None
+
+    def get(self, namespace, embedding):
+        """
+        Finds the most similar cached request in a namespace.
+
+        Args:
+            namespace (str): The namespace to search
+            embedding: The embedding of the new request, as returned by embed()
+
+        Returns:
+            str: The cached response if the best match is at least `threshold` similar, else None
+        """
+        entries = self._namespaces.get(namespace)
+        if embedding is None or entries is None or entries.size == 0:
+            return None
+
+        # Embeddings are normalized, so the dot product is the cosine similarity.
+        scores = entries.matrix[:entries.size].astype(np.float32) @ embedding.astype(np.float32)
+        scores[entries.created[:entries.size] < self._cutoff()] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            entries.last_used[best] = time.monotonic()
+            return entries.responses[best]
+        return None
+
+    def add(self, namespace, embedding, response):
+        """
+        Stores a response under the embedding of the request that produced it, first dropping expired
+        entries and, if the namespace is full, its least recently used entry.
+        """
+        if embedding is None:
+            return
+        entries = self._namespaces.setdefault(namespace, _SemanticNamespace())
+
+        evicted = []
+        if entries.size:
+            evicted = [entries.remove(i) for i in entries.expired(self._cutoff())]
+        if entries.size >= self.maxsize:
+            evicted.append(entries.remove(int(np.argmin(entries.last_used[:entries.size]))))
+        self._delete(evicted)
+
+        now = int(time.time())
+        cursor = self._db.execute(
+            "INSERT INTO entries (namespace, embedding, response, ts) VALUES (?, ?, ?, ?)",
+            (namespace, embedding.tobytes(), response, now),
+        )
+        self._db.commit()
+        entries.append(cursor.lastrowid, embedding, response, now, self.maxsize)
+
+
+class ImageCache:
+    """
+    SQLite-backed cache of generated image URLs, keyed by a hash of the final image prompt.
+
+    BFL result URLs are signed and stop working after about 10 minutes, so entries expire after `ttl`
+    seconds by default.
+    """
+
+    def __init__(self, path="img_cache.db", ttl=600):
+        self.ttl = ttl
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS imgs (key TEXT PRIMARY KEY, url TEXT, ts INTEGER)")
+
+    def get(self, key):
+        """
+        Returns:
+            str: The cached image URL, or None on a miss or an expired entry
+        """
+        row = self._db.execute(
+            "SELECT url FROM imgs WHERE key = ? AND ts >= ?", (key, int(time.time()) - self.ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, url):
+        self._db.execute(
+            "INSERT OR REPLACE INTO imgs (key, url, ts) VALUES (?, ?, ?)", (key, url, int(time.time()))
+        )
+        self._db.commit()
+
+    def close(self):
+        """
+        Closes the database. Call this once when shutting down.
+        """
+        self._db.close()
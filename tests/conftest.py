@@ -0,0 +1,86 @@
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import agent as agent_module  # noqa: E402
+
+
+class FakeMessage:
+    """
+    Stands in for the discord.Message that requested a build, recording the replies sent to it.
+    """
+
+    def __init__(self, content, id=1, replies=None):
+        self.content = content
+        self.id = id
+        self.replies = [] if replies is None else replies
+
+    async def reply(self, content):
+        self.replies.append(content)
+        return FakeMessage(content, replies=self.replies)
+
+    async def edit(self, content):
+        pass
+
+
+class FakeChat:
+    """
+    Stands in for the chat API of the Mistral client, streaming a fixed response a few characters at a time.
+    """
+
+    def __init__(self, response, on_close=None):
+        """
+        Args:
+            response (str): The response to stream
+            on_close: Called when a stream is closed, if given
+        """
+        self.response = response
+        self.on_close = on_close
+        self.calls = 0
+
+    async def stream_async(self, model, messages, **params):
+        self.calls += 1
+        return _FakeEventStream(self.response, self.on_close)
+
+
+class _FakeEventStream:
+    def __init__(self, response, on_close):
+        self.response = response
+        self.on_close = on_close
+
+    async def __aenter__(self):
+        return self._events()
+
+    async def __aexit__(self, *exc_info):
+        if self.on_close is not None:
+            self.on_close()
+
+    async def _events(self):
+        for i in range(0, len(self.response), 7):
+            await asyncio.sleep(0)
+            delta = SimpleNamespace(content=self.response[i:i + 7])
+            yield SimpleNamespace(data=SimpleNamespace(choices=[SimpleNamespace(delta=delta)]))
+
+
+@pytest.fixture
+def builder_agent(tmp_path, monkeypatch):
+    """
+    A BuilderAgent whose caches live in a temporary directory. Image generations are not started.
+    """
+    monkeypatch.chdir(tmp_path)
+    builder = agent_module.BuilderAgent()
+    builder.started_prompts = []
+
+    async def generate_cached(final_prompt):
+        builder.started_prompts.append(final_prompt)
+        return {'id': f"generation-{len(builder.started_prompts)}"}
+
+    builder._generate_cached = generate_cached
+    yield builder
+    asyncio.run(builder.close())
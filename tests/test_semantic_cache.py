@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+import cache
+from conftest import FakeChat, FakeMessage
+
+np = pytest.importorskip("numpy")
+
+INSTRUCTIONS = "Build: a chair\nMaterials:\n- wood\n\nInstructions:\n#### Step 1: Cut the legs\n#### Step 2: Glue\n"
+
+
+class _OfflineSentenceTransformer:
+    def __init__(self, model_name):
+        raise OSError(f"We couldn't connect to 'https://huggingface.co' to load {model_name}")
+
+
+def test_build_completes_when_the_embedding_model_fails_to_load(builder_agent, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "np", np)
+    monkeypatch.setattr(cache, "SentenceTransformer", _OfflineSentenceTransformer)
+    builder_agent.semantic_cache = cache.SemanticCache(path=str(tmp_path / "semantic_cache.db"))
+    builder_agent.client.chat = FakeChat(INSTRUCTIONS)
+
+    async def build():
+        await builder_agent.semantic_cache.load_model()
+        return await builder_agent.run(FakeMessage("Bob, please build me a chair"))
+
+    instruction = asyncio.run(build())
+
+    assert not builder_agent.semantic_cache.enabled
+    assert builder_agent.client.chat.calls == 1
+    assert "#### Step 2: Glue" in instruction
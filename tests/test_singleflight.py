@@ -0,0 +1,54 @@
+import asyncio
+
+
+def test_waiter_reruns_the_request_when_the_owner_is_cancelled(builder_agent):
+    calls = []
+
+    async def call():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        return calls[-1]
+
+    async def scenario():
+        owner = asyncio.create_task(builder_agent._singleflight("key", call))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(builder_agent._singleflight("key", call))
+        await asyncio.sleep(0)
+        owner.cancel()
+        return await waiter
+
+    assert asyncio.run(scenario()) == 1
+    assert calls == [0, 1]
+    assert builder_agent._inflight == {}
+
+
+def test_waiters_share_the_result_of_the_request(builder_agent):
+    calls = []
+
+    async def call():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def scenario():
+        return await asyncio.gather(*(builder_agent._singleflight("key", call) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == ["result"] * 3
+    assert len(calls) == 1
+
+
+def test_cancelling_a_waiter_leaves_the_request_running(builder_agent):
+    async def call():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def scenario():
+        owner = asyncio.create_task(builder_agent._singleflight("key", call))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(builder_agent._singleflight("key", call))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return waiter.cancelled(), await owner
+
+    assert asyncio.run(scenario()) == (True, "result")
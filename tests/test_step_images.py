@@ -0,0 +1,45 @@
+import asyncio
+
+from agent import illustrated_step_indices
+from bot_text import process_response
+from conftest import FakeChat, FakeMessage
+
+INSTRUCTIONS = (
+    "Build: a table\n"
+    "Materials:\n- 4 legs, 30 inches long\n\n"
+    "Instructions:\n"
+    "#### Step 1: Cut the legs\nEach leg should be 30 inches long.\n"
+    "#### Step 2: Sand the top\n"
+    "#### Step 3: Attach the legs\nUse 2 screws per leg.\n"
+)
+
+
+def test_prefetched_and_requested_step_images_share_prompts(builder_agent):
+    started_while_streaming = []
+    builder_agent.client.chat = FakeChat(
+        INSTRUCTIONS, on_close=lambda: started_while_streaming.extend(builder_agent.started_prompts)
+    )
+
+    async def scenario():
+        instruction = await builder_agent.run(FakeMessage("Bob, please build a table", id=1))
+        await asyncio.sleep(0)
+        prefetched = list(builder_agent.started_prompts)
+
+        # The images bot.py asks for: for this build they come from the prefetch, for another build
+        # they are generated anew.
+        steps = [section for is_step, section in process_response(instruction) if is_step]
+        for index in illustrated_step_indices(len(steps)):
+            await builder_agent.generate_image_step(steps[index], build_id=1, step_number=index + 1)
+        for index in illustrated_step_indices(len(steps)):
+            await builder_agent.generate_image_step(steps[index], build_id=2, step_number=index + 1)
+        return prefetched, builder_agent.started_prompts[len(prefetched):]
+
+    prefetched, requested = asyncio.run(scenario())
+
+    assert len(prefetched) == 3
+    # The first step is illustrated while the rest of the instructions are still streaming.
+    assert started_while_streaming == prefetched[:1]
+    assert requested == prefetched
+    # Every line of a multi-line step makes it into the prompt.
+    assert "**30 inches** long." in prefetched[0]
+    assert "Use 2 screws per leg." in prefetched[-1]